@@ -1,62 +1,185 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import re, json, os
+import os, glob
+import multiprocessing
 from os import path as op
 from collections import Counter, defaultdict
 from tqdm import tqdm
 import copy
+try: # orjson is much faster when available
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try: # re2 guarantees linear time matching when available
+    import re2 as _re
+except ImportError:
+    import re as _re
+
+# default gold labels of NLI problems
+_LABELS = ('entailment', 'neutral', 'contradiction')
+_LABEL_SET = frozenset(_LABELS)
+
+# matches a leaf of a tree, i.e. a (postag token) pair
+_LEAF = _re.compile(r'\(([^()\s]+)\s+([^()]+)\)')
 
 ########################################################################
-def snli_jsonl2dict(snli_dir, clean_labels=True, gold_labels=['entailment', 'neutral', 'contradiction']):
+def snli_jsonl2dict(snli_dir, clean_labels=True, gold_labels=_LABELS, processes=1):
     """
     Reads jsonl files of snli parts and returns
     snli dict that contains problem level info: {part: {prob_id: Problem info}}
     sen2anno dict that contains sentence annotations: {sen:annotation dict}
     It is efficient to separate problem- and sentence-level info as
     many sentences reoccur in several problems.
+    Use iter_snli_jsonl to stream problems instead of keeping them in memory.
+    processes is the number of processes reading the parts (None for one per CPU).
+    Sending the read parts back from worker processes is costly, so more than one
+    process only pays off for large parts on several CPUs; scripts that use it
+    need an if __name__ == '__main__' guard on platforms that spawn processes.
     """
-    # Find .jsonl files corresponding to data parts
-    PARTS = [ f[9:-6] for f in os.listdir(snli_dir) if re.match('.+_(train|dev|test).jsonl', f) ]
-    if not PARTS:
-        raise RuntimeError(f"No .jsonl files were found in {snli_dir}")
-    else:
-        print(f"Found .json files for {PARTS} parts")
+    PARTS = _find_parts(snli_dir)
     # Initializing values
     snli = defaultdict(dict)
     sen2anno = defaultdict(dict) # maps sentence strings to its annotations 
-    cleaned = 0
-    label_set = set(gold_labels)
-    # Reading part files one by one
-    for s in PARTS:
-        weird_lab= {'cnt': Counter(), 'pids': []} # record problems with weird labels if any
-        print("processing " + s.upper(), end=':\t')
-        with open(op.join(snli_dir, f'snli_1.0_{s}.jsonl')) as F:
-            for line in tqdm(F):
-                prob = json.loads(line)
-                # if problem's gold label is not in predefined gold labels, ignore
-                if prob['gold_label'] not in label_set: continue
-                # test if the problem has weird labels
-                weird_labs = set(prob['annotator_labels']) - label_set
-                if weird_labs:
-                    weird_lab['cnt'].update(weird_labs)
-                    weird_lab['pids'].append(prob['pairID'])
-                if clean_labels and weird_labs: 
-                    continue # ignore problems with weird labels
-                # read a problem in a dict
-                prob, p_anno, h_anno = json_prob2dict(prob, labels=gold_labels)
-                snli[s][prob['pid']] = prob
-                # update sentences annotations
-                sen2anno = update_sen2anno(sen2anno, prob['p'], p_anno, (s, prob['pid'], 'p'))
-                sen2anno = update_sen2anno(sen2anno, prob['h'], h_anno, (s, prob['pid'], 'h'))
-        print(f"{len(snli[s])} problems read")
-        print(f"{len(weird_lab['pids'])} problems have a wrong annotator label")
-    if weird_lab['cnt']:  
-        most_common_weird = ','.join([ f"/{k}/({c})" for k, c in weird_lab['cnt'].most_common() ])
-        print(f"Most common weird labels: {most_common_weird}")
+    weird_cnt = Counter() # counts weird labels across all parts
+    if processes is None:
+        processes = os.cpu_count() or 1
+    part_args = [ (snli_dir, s, clean_labels, gold_labels) for s in PARTS ]
+    if min(processes, len(PARTS)) > 1:
+        # Reading part files in parallel as they are independent
+        with multiprocessing.Pool(min(processes, len(PARTS))) as pool:
+            results = pool.map(_load_part, part_args)
+    else:
+        results = map(_load_part, part_args)
+    for s, part_snli, part_sen2anno, weird_lab in results:
+        snli[s] = part_snli
+        # merge sentence annotations of the part into the common ones
+        for sen, anno in part_sen2anno.items():
+            if sen in sen2anno:
+                sen2anno[sen]['pids'].update(anno['pids'])
+            else:
+                sen2anno[sen] = anno
+        _report_part(s, len(snli[s]), weird_lab, weird_cnt)
+    _report_weird_labels(weird_cnt)
     return snli, sen2anno
 
 
+########################################################################
+def iter_snli_jsonl(snli_dir, clean_labels=True, gold_labels=_LABELS):
+    """
+    Streaming version of snli_jsonl2dict: reads jsonl files of snli parts
+    one problem at a time without keeping them in memory.
+    Yields (part, prob_id, Problem info, premise annotation, hypothesis annotation) tuples.
+    Part and weird label statistics are printed after each part as in snli_jsonl2dict.
+    Use sen_anno_pairs to feed the stream to sen_analysis.spacy_sen_context.
+    """
+    label_set = _LABEL_SET if gold_labels is _LABELS else set(gold_labels)
+    weird_cnt = Counter() # counts weird labels across all parts
+    for s in _find_parts(snli_dir):
+        weird_lab = {'cnt': Counter(), 'pids': []}
+        prob_num = 0
+        for pid, prob, p_anno, h_anno in _iter_part(snli_dir, s, clean_labels, gold_labels, label_set, weird_lab):
+            prob_num += 1
+            yield s, pid, prob, p_anno, h_anno
+        _report_part(s, prob_num, weird_lab, weird_cnt)
+    _report_weird_labels(weird_cnt)
+
+
+########################################################################
+def _report_part(s, prob_num, weird_lab, weird_cnt):
+    """
+    Prints how many problems of part s were read and how many have weird labels,
+    and adds the weird label counts of the part to weird_cnt in place
+    """
+    weird_cnt.update(weird_lab['cnt'])
+    print(f"{s.upper()}:\t{prob_num} problems read")
+    print(f"{len(weird_lab['pids'])} problems have a wrong annotator label")
+
+
+def _report_weird_labels(weird_cnt):
+    """
+    Prints the weird labels counted across all parts, if any
+    """
+    if weird_cnt:
+        most_common_weird = ','.join([ f"/{k}/({c})" for k, c in weird_cnt.most_common() ])
+        print(f"Most common weird labels: {most_common_weird}")
+
+
+########################################################################
+def sen_anno_pairs(problems):
+    """
+    Turns a stream of problems from iter_snli_jsonl into a stream of
+    (sentence, annotation) pairs, one for the premise and one for the hypothesis
+    of each problem, as expected by sen_analysis.spacy_sen_context.
+    Each annotation gets a 'pids' set referring to the problem, as in sen2anno.
+    """
+    for s, pid, prob, p_anno, h_anno in problems:
+        p_anno['pids'] = set([(s, pid, 'p')])
+        yield prob['p'], p_anno
+        h_anno['pids'] = set([(s, pid, 'h')])
+        yield prob['h'], h_anno
+
+
+########################################################################
+def _find_parts(snli_dir):
+    """
+    Find .jsonl files corresponding to data parts and return the part names
+    """
+    PARTS = [ op.basename(f)[9:-6] for f in glob.glob(op.join(snli_dir, 'snli_1.0_*.jsonl')) ]
+    if not PARTS:
+        raise RuntimeError(f"No .jsonl files were found in {snli_dir}")
+    else:
+        print(f"Found .json files for {PARTS} parts")
+    return PARTS
+
+
+########################################################################
+def _load_part(args):
+    """
+    Reads a jsonl file of a single snli part.
+    args is a tuple (snli_dir, part, clean_labels, gold_labels) so that
+    the function can be mapped over parts by a process pool.
+    Returns a tuple of the part, {prob_id: Problem info} dict of the part,
+    sen2anno dict for the sentences of the part, and weird label records
+    """
+    snli_dir, s, clean_labels, gold_labels = args
+    snli_part = dict()
+    sen2anno = dict()
+    label_set = _LABEL_SET if gold_labels is _LABELS else set(gold_labels)
+    weird_lab = {'cnt': Counter(), 'pids': []} # record problems with weird labels if any
+    for pid, prob, p_anno, h_anno in _iter_part(snli_dir, s, clean_labels, gold_labels, label_set, weird_lab):
+        snli_part[pid] = prob
+        # update sentences annotations
+        update_sen2anno(sen2anno, prob['p'], p_anno, (s, pid, 'p'))
+        update_sen2anno(sen2anno, prob['h'], h_anno, (s, pid, 'h'))
+    return s, snli_part, sen2anno, weird_lab
+
+
+########################################################################
+def _iter_part(snli_dir, s, clean_labels, gold_labels, label_set, weird_lab):
+    """
+    Reads a jsonl file of a single snli part and yields
+    (prob_id, Problem info, premise annotation, hypothesis annotation) tuples.
+    Problems with weird labels are recorded in weird_lab in place.
+    """
+    with open(op.join(snli_dir, f'snli_1.0_{s}.jsonl'), 'rb') as F:
+        for line in tqdm(F, desc=s.upper()):
+            prob = _json.loads(line)
+            # if problem's gold label is not in predefined gold labels, ignore
+            if prob['gold_label'] not in label_set: continue
+            # test if the problem has weird labels
+            weird_labs = [ l for l in prob['annotator_labels'] if l not in label_set ]
+            if weird_labs:
+                weird_lab['cnt'].update(set(weird_labs)) # count problems, not annotator votes
+                weird_lab['pids'].append(prob['pairID'])
+            if clean_labels and weird_labs: 
+                continue # ignore problems with weird labels
+            # read a problem in a dict
+            prob, p_anno, h_anno = json_prob2dict(prob, labels=gold_labels, label_set=label_set)
+            yield prob['pid'], prob, p_anno, h_anno
+
+
 ########################################################################
 def update_sen2anno(sen2anno, sen, sen_anno, part_id_ph):
     """
@@ -72,7 +195,7 @@ def update_sen2anno(sen2anno, sen, sen_anno, part_id_ph):
 
 
 ########################################################################
-def json_prob2dict(prob, labels=['entailment', 'neutral', 'contradiction']):
+def json_prob2dict(prob, labels=_LABELS, label_set=None):
     """
     Reprocess a prob dict and create a more informative dictionary 
     that records easily accessible info for an NLI problems.
@@ -85,12 +208,16 @@ def json_prob2dict(prob, labels=['entailment', 'neutral', 'contradiction']):
     Premise and hypothesis annotation dict contain the info:
     tok: list of tokens in a sentence, pos: a list of pos tags of tokens,
     tree: a phrase structure tree of a sentence, btree: a binary phrase structure tree of a sentence. 
+    label_set is a set of labels; it is computed from labels if not provided.
     """
-    label_set = set(labels)
+    if label_set is None:
+        label_set = _LABEL_SET if labels is _LABELS else set(labels)
     p = { 'g':prob['gold_label'], 'pid':prob['pairID'], 'cid':prob['captionID'] }
-    p['lnum'] = len([ l for l in prob['annotator_labels'] if l in label_set ])
-    p['lcnt'] = Counter([ l for l in prob['annotator_labels'] if l in label_set ])
-    p['ltype'] = ''.join([ str(p['lcnt'][l]) for l in labels ])
+    # a single pass over annotator labels
+    cnt = Counter( l for l in prob['annotator_labels'] if l in label_set )
+    p['lnum'] = sum(cnt.values())
+    p['lcnt'] = cnt
+    p['ltype'] = ''.join( str(cnt[l]) for l in labels )
     p['p'], p['h'] = prob['sentence1'], prob['sentence2']
     # Premise sentence annotations
     p_anno = read_sentence_anno(prob['sentence1_parse'], prob['sentence1_binary_parse'])
@@ -108,10 +235,11 @@ def read_sentence_anno(tree, btree):
         tree: tree as a string, btree: binary tree as a string }
     """
     anno = { 'tree': tree, 'btree': btree }
-    anno['tok'] = [ t for t in re.split('[)( ]+', anno['btree']) if t ]
-    anno['pos'] = re.findall('\(([^()]+)\s+[^()]+\)', anno['tree'])
-    # check that the number of tokens coincides with the number of pos tags
-    assert len(anno['pos']) == len(anno['tok']), f"{i}: len({anno['pos']}) =/= len({anno['tok']})"
+    # a single pass over the tree gives tokens and their pos tags,
+    # so their numbers coincide by construction
+    pairs = _LEAF.findall(tree)
+    anno['tok'] = [ t for _, t in pairs ]
+    anno['pos'] = [ p for p, _ in pairs ]
     return anno
 
 
@@ -131,3 +259,25 @@ def sen2anno_from_nli_problems(nli_dict, sen2anno):
     return s2a
     
     
+
+
+########################################################################
+def snli2table(snli, sen2anno=None):
+    """
+    Converts snli dict {part: {prob_id: Problem info}} into a pyarrow Table
+    with a row per problem and columns part, pid, cid, g, lnum, ltype, p, h.
+    If sen2anno is given, premise and hypothesis annotations are added as
+    ptok, ppos, ptree, htok, hpos, htree columns.
+    Columnar layout makes filtering and counting cheap, e.g.
+    table.filter(pyarrow.compute.field('ltype') == '500')
+    """
+    import pyarrow as pa
+    probs = [ (part, prob) for part, part_probs in snli.items() for prob in part_probs.values() ]
+    columns = { 'part': [ part for part, _ in probs ] }
+    for k in ('pid', 'cid', 'g', 'lnum', 'ltype', 'p', 'h'):
+        columns[k] = [ prob[k] for _, prob in probs ]
+    if sen2anno is not None:
+        for ph in "ph":
+            for k in ('tok', 'pos', 'tree'):
+                columns[f"{ph}{k}"] = [ sen2anno[prob[ph]][k] for _, prob in probs ]
+    return pa.table({ k: pa.array(v) for k, v in columns.items() })
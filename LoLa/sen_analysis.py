@@ -2,7 +2,9 @@
 # -*- coding: utf8 -*-
 
 import spacy
+from spacy.tokens import Doc
 import itertools
+import os
 from tqdm import tqdm
 
 def tokenized2Doc(spacy_pipeline, raw, tokens):
@@ -10,25 +12,45 @@ def tokenized2Doc(spacy_pipeline, raw, tokens):
     Takes raw text and its tokenized version and returns spaCy's Doc object 
     """
     # TODO: initialize spaces arg too, now it defults to the list of True
-    return spacy.tokens.Doc(spacy_pipeline.vocab, words=tokens)
+    return Doc(spacy_pipeline.vocab, words=tokens)
 
 
-def spacy_sen_context(spacy_nlp, sen_context_dict, disable_components=[], n=0):
+def spacy_sen_context(spacy_nlp, sen_context_dict, disable_components=[], n=0,
+                      batch_size=256, n_process=1):
     """
     Takes spacy_nlp pipeline and processes sentences in sen_context_dict
     where the latter is {sen->context}, context carrying additional info about sentences.
+    sen_context_dict can also be an iterable of (sen, context) pairs where sentences may repeat;
+    each distinct sentence is processed by spacy only once and its Doc is shared by all its contexts.
+    If the contexts have 'pids' sets, as read_nli.sen_anno_pairs gives, the returned context
+    of a sentence gets the pids of all its contexts, as in sen2anno.
     n - does cut off
     disable_components - a list of spacy pipeline components that will be disabled during processing.
+    batch_size, n_process - passed to spacy_nlp.pipe; n_process=None uses all but one CPUs.
     Returns sen->anno dict where anno has an additional key 'spacy' with value of spacy Doc
     Note that the function modifies sen_context_dict
     """
-    if not n: n = len(sen_context_dict)
-    doc_sen_anno = [ (tokenized2Doc(s, a['tok'], spacy_nlp), (s, a)) for s, a in itertools.islice(sen_context_dict.items(), n) ]
+    sen_context = sen_context_dict.items() if isinstance(sen_context_dict, dict) else sen_context_dict
+    # keep the first context of each sentence, the rest only get the Doc afterwards
+    unique, repeated = dict(), []
+    for s, a in itertools.islice(sen_context, n or None):
+        if s in unique:
+            repeated.append((s, a))
+            if 'pids' in a and 'pids' in unique[s]:
+                unique[s]['pids'].update(a['pids'])
+        else:
+            unique[s] = a
+    if n_process is None: n_process = max(1, (os.cpu_count() or 1) - 1)
+    # Docs are created lazily while spacy consumes them.
+    # Only sentences go along with the Docs: worker processes would return copies of contexts
+    doc_sen = ( (tokenized2Doc(spacy_nlp, s, a['tok']), s) for s, a in unique.items() )
     sen_anno = dict() # a dictionary with sentence keys and anno gets additional key for 'spacy' that has spacy Doc as value
     with spacy_nlp.select_pipes(disable=disable_components):
-        for doc, (sen, anno) in tqdm(spacy_nlp.pipe(doc_sen_anno, as_tuples=True)):
-            sen_anno[sen] = anno
+        for doc, sen in tqdm(spacy_nlp.pipe(doc_sen, as_tuples=True, batch_size=batch_size, n_process=n_process), total=len(unique)):
+            sen_anno[sen] = unique[sen]
             sen_anno[sen]['spacy'] = doc
+    for sen, anno in repeated:
+        anno['spacy'] = sen_anno[sen]['spacy']
     return sen_anno
 
 
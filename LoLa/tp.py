@@ -7,9 +7,19 @@ contact: Lasha.Abzianidze@uu.nl
 """
 
 from typing import List, Tuple, Dict
+from functools import lru_cache
 import nltk
 import re
 
+#########################################################
+@lru_cache(maxsize=100_000)
+def _parse(s: str) -> nltk.sem.Expression:
+    """ 
+    Parses a formula string into an NLTK expression.
+    Parses are memoized as the same formulas are often proved repeatedly.
+    """
+    return nltk.sem.Expression.fromstring(s)
+
 #########################################################
 def tableau_prove(conclusion: str, premises: List[str] = [], verbose: bool = False) -> bool:
     """ 
@@ -17,9 +27,8 @@ def tableau_prove(conclusion: str, premises: List[str] = [], verbose: bool = Fal
     detects whether the premises entail the conclusion.
     Returns a boolean value and optionally prints the tableau structure
     """
-    str2exp = nltk.sem.Expression.fromstring
-    c = str2exp(conclusion)
-    ps = [ str2exp(p) for p in premises ] 
+    c = _parse(conclusion)
+    ps = [ _parse(p) for p in premises ] 
     return nltk.TableauProver().prove(c, ps, verbose=verbose)
 
 #########################################################
@@ -29,9 +38,8 @@ def prover9_prove(path: str, conclusion: str, premises: List[str] = []) -> bool:
     tries to prove whether the premises entail the conclusion.
     Returns a boolean value indicating whether the proof was found
     """
-    str2exp = nltk.sem.Expression.fromstring
-    c = str2exp(conclusion)
-    ps = [ str2exp(p) for p in premises ]
+    c = _parse(conclusion)
+    ps = [ _parse(p) for p in premises ]
     prover9 = nltk.Prover9()
     if path: prover9.config_prover9(path)
     return prover9.prove(c, ps)
@@ -46,15 +54,21 @@ def make_vars_consistent(prop_maps: List[Tuple[str, Dict[str,str]]],
     It renames all propositional letters in the formulas and makes sure that 
     the mapping from letter to sentences is one to one.
     """
-    all_sents = set([ v for (_, m) in prop_maps for k, v in m.items() ])
-    sent2index = { s: i for i, s in enumerate(sorted(all_sents), start=1) }
+    # number sentences in the order of their first occurrence
+    sent2index = dict()
+    for _, m in prop_maps:
+        for s in m.values():
+            if s not in sent2index:
+                sent2index[s] = len(sent2index) + 1
     mapping, props = dict(), []
     for prop, m in prop_maps:
-        for pi, sent in m.items():
-            qi = f"{prop_letter}{sent2index[sent]}"
-            prop = re.sub(fr'\b{pi}\b', qi, prop)
+        for sent in m.values():
+            mapping[f"{prop_letter}{sent2index[sent]}"] = sent
+        if m:
+            # rename all letters of the formula in a single pass
+            pat = re.compile(r'\b(' + '|'.join(map(re.escape, m.keys())) + r')\b')
+            prop = pat.sub(lambda mo: f"{prop_letter}{sent2index[m[mo.group(1)]]}", prop)
         props.append(prop)
-        mapping[qi] = sent
     return props, mapping    
 
 
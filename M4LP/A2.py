@@ -1,5 +1,5 @@
 import subprocess
-import os
+from pathlib import Path
 from os import path as op
 import re
 from sklearn.metrics import confusion_matrix, accuracy_score, ConfusionMatrixDisplay
@@ -49,18 +49,15 @@ def run_cmd(cmd, v=False):
     """ run cmd and print stdout lines while the command is running if v is True.
         Return the stdout as a string
     """
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
-                            stderr=subprocess.STDOUT, text=True, shell=True)
-    out_str = ''  
-    while(True):
-        out = p.poll() 
-        line = p.stdout.readline()
-        if line: 
-            out_str += line
+    chunks = [] # joined at the end to avoid quadratic string concatenation
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, shell=True, bufsize=1) as p:
+        # reading until EOF doesn't lose lines printed right before the exit
+        for line in p.stdout:
+            chunks.append(line)
             if v: print(line, end="")
-        if out is not None:
-            break
-    return out_str
+        p.wait()
+    return ''.join(chunks)
 
 def show_tableau(filename, tableau_css='/content/LangPro/css/tableau.css'):
     """ Intended for google colab use
@@ -102,15 +99,15 @@ class LangPro:
         assert op.isfile(self.wn_pl), f"{self.wn_pl} is not a file"
         self.parses = dict()
         possible_parsers = "cc2016 easyccg depccg".split()
-        for f in os.listdir(data_dir):
-            if f.endswith('anno_sen.pl'): 
-                self.tok_anno_pl = op.abspath(op.join(data_dir, f))
-            elif f.endswith('_sen.pl'): 
-                self.sen_pl = op.abspath(op.join(data_dir, f)) 
+        for f in Path(data_dir).glob('*'):
+            if f.name.endswith('anno_sen.pl'): 
+                self.tok_anno_pl = op.abspath(f)
+            elif f.name.endswith('_sen.pl'): 
+                self.sen_pl = op.abspath(f) 
             else:
                 for p in possible_parsers:
-                    if f"_{p}" in f: 
-                        self.parses[p] = op.abspath(op.join(data_dir, f))
+                    if f"_{p}" in f.name: 
+                        self.parses[p] = op.abspath(f)
                         break
         for a in ["tok_anno_pl", "sen_pl"]:
             if a not in dir(self): 
@@ -5,11 +5,10 @@ N. Robertson and P. Seymour (Eds.), Graph Structure Theory, pp. 565—590. AMS.
 @author: Meaghan Fowlie
 """
 
-import copy
+import itertools
 import logging
 import sys
-from copy import deepcopy
-from typing import Set, Iterable
+from typing import Set
 import penman
 from .mtool.smatch import get_amr_match, compute_f
 
@@ -19,6 +18,45 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def _intern(s):
+    """
+    Interns label strings, so the many copies of labels like ":ARG0" share memory and compare fast.
+    """
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+# marks a missing value where None could be a value
+_SENTINEL = object()
+
+# Smatch only strips the prefix off node names, so both graphs can use the same one
+_SMATCH_PREFIX = "n"
+
+
+def _smatch_from_triples(triples1, triples2, sentence_ids1=None, sentence_ids2=None):
+    """
+    Computes the Smatch F-score of two graphs given as the triples of SGraph._get_triples,
+    without going through their penman encoding.
+    If both sentence_ids are given, only nodes that share at least one sentence id can be aligned.
+    Returns: float
+    """
+    instance1, attributes1, relation1, nodes1 = triples1
+    instance2, attributes2, relation2, nodes2 = triples2
+    candidate_filter = None
+    if sentence_ids1 is not None and sentence_ids2 is not None:
+        ids1 = [sentence_ids1.get(n, set()) for n in nodes1]
+        ids2 = [sentence_ids2.get(n, set()) for n in nodes2]
+
+        def candidate_filter(i, j):
+            return not ids1[i] or not ids2[j] or bool(ids1[i] & ids2[j])
+    match_num, test_num, gold_num, _ = get_amr_match(None, None,
+                                                     instance1=instance1, attributes1=attributes1,
+                                                     relation1=relation1, prefix1=_SMATCH_PREFIX,
+                                                     instance2=instance2, attributes2=attributes2,
+                                                     relation2=relation2, prefix2=_SMATCH_PREFIX,
+                                                     candidate_filter=candidate_filter)
+    return compute_f(match_num, test_num, gold_num)[2]
+
+
 class GraphError(Exception):
     def __init__(self, message=None):
         self.message = message
@@ -35,13 +73,18 @@ class SGraph:
         node_labels: dict from node to label
         sources: dict from source to node
         root: int: specially marked node
+        sentence_ids: optional dict from node to the set of ids of the sentences it comes from
     """
 
+    __slots__ = ('nodes', 'edges', 'node_labels', 'sources', 'root', 'sentence_ids')
+
     def __init__(self, nodes: set[int] = None,
                  edges: dict[int: list[tuple[int, str]]] or None = None,
                  node_labels: dict[int:str] or None = None,
                  sources: dict[str:int] or None = None,
-                 root: int or None = None):
+                 root: int or None = None,
+                 sentence_ids: dict[int:set[int]] or None = None,
+                 validate: bool = True):
         """
         Initialise an SGraph
         Args:
@@ -51,29 +94,67 @@ class SGraph:
             node_labels: dict from int to str: the node labelling function.
             sources: dict from str to int: the source function, mapping sources to nodes.
             root: int: the root node of the graph.
+            sentence_ids: dict from int to set of ints: the sentences each node comes from, for document-level graphs.
+                          If both graphs have them, equality only aligns nodes that share a sentence.
+            validate: bool: if True (the default), check that the graph makes sense with validate()
+                      and intern its labels. Pass False to skip both for graphs already known to be
+                      consistent. Graphs built internally by _shallow_clone, and so by merge and __add__,
+                      don't go through __init__ at all and are never validated.
         """
-        # check the types of the inputs
-        assert nodes is None or isinstance(nodes, Set), f"Nodes must be of type Set but is {type(nodes)}"
-        assert edges is None or isinstance(edges, dict), f"Edges must be of type dict but is {type(edges)}"
-        assert node_labels is None or isinstance(node_labels,
-                                                 dict), f"node_labels must be of type dict but is {type(node_labels)}"
-        assert sources is None or isinstance(sources, dict), f"sources must be of type dict but is {type(sources)}"
-        assert root is None or isinstance(nodes, Iterable) and root in nodes, f"root must be in nodes"
-
         # default is an empty graph
         self.nodes = set() if nodes is None else nodes
         self.edges = {} if edges is None else edges
         self.node_labels = {} if node_labels is None else node_labels
         self.sources = {} if sources is None else sources
         self.root = root
+        self.sentence_ids = sentence_ids
+        if validate:
+            self.validate()
+            # intern the labels in place once the edge lists are known to be lists;
+            # merge, add_source and rename intern what they insert
+            for node, label in self.node_labels.items():
+                self.node_labels[node] = _intern(label)
+            for edges in self.edges.values():
+                edges[:] = [(target, _intern(label)) for target, label in edges]
+
+    def validate(self):
+        """
+        Checks the types of the attributes and that the graph makes sense.
+        Raises AssertionError if it doesn't.
+        """
+        # check the types of the attributes
+        assert isinstance(self.nodes, Set), f"Nodes must be of type Set but is {type(self.nodes)}"
+        assert isinstance(self.edges, dict), f"Edges must be of type dict but is {type(self.edges)}"
+        assert isinstance(self.node_labels, dict), \
+            f"node_labels must be of type dict but is {type(self.node_labels)}"
+        assert isinstance(self.sources, dict), f"sources must be of type dict but is {type(self.sources)}"
+        assert self.root is None or self.root in self.nodes, f"root must be in nodes"
+        assert self.sentence_ids is None or isinstance(self.sentence_ids, dict), \
+            f"sentence_ids must be of type dict but is {type(self.sentence_ids)}"
 
         # check the graph makes sense
-        assert set(self.edges.keys()).issubset(self.nodes), f"Edges must be subset of nodes x nodes"
-        assert all([isinstance(value, list) for value in self.edges.values()]), f"edge values must be lists"
-        assert set(self.sources.values()).issubset(self.nodes), f"Sources must be subset of nodes"
-        assert set(self.node_labels.keys()).issubset(self.nodes), \
+        assert all(origin in self.nodes for origin in self.edges), f"Edges must be subset of nodes x nodes"
+        assert all(isinstance(value, list) for value in self.edges.values()), f"edge values must be lists"
+        assert all(node in self.nodes for node in self.sources.values()), f"Sources must be subset of nodes"
+        assert all(node in self.nodes for node in self.node_labels), \
             f"Node labeling refers to non-existent nodes: {set(self.node_labels.keys())} vs {self.nodes}"
 
+    def _shallow_clone(self):
+        """
+        Copies the graph structure without going through deepcopy or __init__ checks.
+        Nodes and edge labels are immutable, so only the containers are copied.
+        Returns: SGraph
+        """
+        clone = object.__new__(type(self))
+        clone.nodes = set(self.nodes)
+        clone.edges = {origin: list(edges) for origin, edges in self.edges.items()}
+        clone.node_labels = dict(self.node_labels)
+        clone.sources = dict(self.sources)
+        clone.root = self.root
+        clone.sentence_ids = None if self.sentence_ids is None else \
+            {node: set(ids) for node, ids in self.sentence_ids.items()}
+        return clone
+
     def get_sources_for_node(self, n):
         """
         Finds all sources for a node.
@@ -81,41 +162,109 @@ class SGraph:
             n: int: the node
         Returns: list of strings, the sources.
         """
-        sources = []
-        for source in self.sources:
-            if n == self.sources[source]:
-                sources.append(source)
-        return sources
+        return [source for source, node in self.sources.items() if node == n]
+
+    def _sources_by_node(self):
+        """
+        Builds the reverse of the source function: a dict from a node to the list of its sources.
+        Returns: dict from int to list of str
+        """
+        sources_by_node = {}
+        for source, node in self.sources.items():
+            sources_by_node.setdefault(node, []).append(source)
+        return sources_by_node
 
     def __str__(self):
         return repr(self)
 
     def __repr__(self):
-        ret = f""
-        ret += f"rt:\t\t\t{self.root}\n"
-        ret += f"nodes:\t\t{self.nodes}\n"
-        ret += f"labels:\t\t{self.node_labels}\n"
-        ret += f"sources:\t{self.sources}\n"
-        ret += f"edges:\n"
+        parts = [f"rt:\t\t\t{self.root}\n",
+                 f"nodes:\t\t{self.nodes}\n",
+                 f"labels:\t\t{self.node_labels}\n",
+                 f"sources:\t{self.sources}\n",
+                 f"edges:\n"]
         for n in self.edges:
             for target, label in self.edges[n]:
-                ret += f"\t {n} {label} {target}\n"
-        return ret
+                parts.append(f"\t {n} {label} {target}\n")
+        return "".join(parts)
 
     def __eq__(self, other):
         # uses Smatch to check equality
         if not isinstance(other, SGraph):
             raise NotImplementedError
         else:
+            if other is self:
+                return True
             try:
                 allowed_error = 0.000001
-                g = penman.encode(self.to_penman())
-                h = penman.encode(other.to_penman())
-                return abs(compute_f(*get_amr_match(g, h))[2] - 1.0) <= allowed_error
+                return abs(self._smatch_score(other) - 1.0) <= allowed_error
             except Exception as e:
                 logger.error(f"graphs {self} and {other} can't be compared due to error {e}")
                 return False
 
+    def _get_triples(self):
+        """
+        Builds the triples Smatch compares straight from the graph.
+        A node is named prefix + its index, with the root first, and its value is its label
+        followed by its sources, e.g. "want<s>", as in to_penman.
+        Edges are relation triples without the leading ":" of the label.
+        Returns: (instance triples, attribute triples, relation triples, nodes),
+                 where nodes lists the nodes of the graph in the order of the Smatch node indices
+        """
+        nodes = sorted(self.nodes)
+        if self.root is not None:
+            nodes.remove(self.root)
+            nodes.insert(0, self.root)
+        names = {node: f"{_SMATCH_PREFIX}{i}" for i, node in enumerate(nodes)}
+        # edges may point to nodes missing from self.nodes, which then become unlabelled nodes
+        for origin, edges in self.edges.items():
+            for node in itertools.chain((origin,), (target for target, _ in edges)):
+                if node not in names:
+                    names[node] = f"{_SMATCH_PREFIX}{len(nodes)}"
+                    nodes.append(node)
+        sources_by_node = self._sources_by_node()
+        values = []
+        for node in nodes:
+            sources = sources_by_node.get(node, [])
+            values.append(self.node_labels.get(node, "") + "".join(f"<{source}>" for source in sources))
+        instances = tuple(("instance", names[node], value) for node, value in zip(nodes, values))
+        attributes = (("TOP", names[self.root], values[0]),) if self.root is not None else ()
+        relations = tuple((label[1:] if label.startswith(":") else label, names[origin], names[target])
+                          for origin, edges in self.edges.items() for target, label in edges)
+        return instances, attributes, relations, nodes
+
+    def _smatch_score(self, other):
+        """
+        Computes the Smatch F-score of the graph against other.
+        If both graphs have sentence_ids, only nodes that share at least one sentence id are
+        considered for the alignment, as in document-level Smatch. This assumes the two graphs
+        number their sentences the same way. Nodes without sentence ids can align with any node.
+        Args:
+            other: SGraph
+        Returns: float
+        """
+        return _smatch_from_triples(self._get_triples(), other._get_triples(),
+                                    self.sentence_ids, other.sentence_ids)
+
+    def smatch_many(self, others):
+        """
+        Computes the Smatch F-score of the graph against each of the other graphs.
+        The triples of the graph are built only once for the whole batch.
+        Args:
+            others: iterable of SGraphs
+        Returns: list of floats, 0.0 for graphs that can't be compared
+        """
+        triples = self._get_triples()
+        scores = []
+        for other in others:
+            try:
+                scores.append(_smatch_from_triples(triples, other._get_triples(),
+                                                   self.sentence_ids, other.sentence_ids))
+            except Exception as e:
+                logger.error(f"graphs {self} and {other} can't be compared due to error {e}")
+                scores.append(0.0)
+        return scores
+
     def is_root(self, node):
         return node == self.root
 
@@ -151,19 +300,17 @@ class SGraph:
             # rename the node qua edge source
             edges = self.edges.pop(old_node)
             self.edges[new_node] = edges
-        # rename the node qua edge target
-        for source in self.edges:
-            new_edges = []
-            for target, label in self.edges[source]:
+        # rename the node qua edge target, rewriting in place only the edges that point to it.
+        # This visits every edge: edges is public and mutable, so an index of incoming edges
+        # kept between calls would go stale when callers edit it directly
+        for edges in self.edges.values():
+            for i, (target, label) in enumerate(edges):
                 if target == old_node:
-                    new_edges.append((new_node, label))
-                else:
-                    new_edges.append((target, label))
-            self.edges[source] = new_edges
+                    edges[i] = (new_node, label)
 
         # sources
-        for source in self.sources:
-            if self.sources[source] == old_node:
+        for source, node in self.sources.items():
+            if node == old_node:
                 self.sources[source] = new_node
 
         # node labels
@@ -171,38 +318,65 @@ class SGraph:
             label = self.node_labels.pop(old_node)
             self.node_labels[new_node] = label
 
+        # sentence ids
+        if self.sentence_ids is not None and old_node in self.sentence_ids:
+            self.sentence_ids[new_node] = self.sentence_ids.pop(old_node)
+
     def __add__(self, other):
         """
         Adds two graphs together, keeping the root at the root of self, and merging shared sources.
         This is the Merge function (||) of the HR algebra.
+        Parallel copies of the same edge are not kept: each (origin, target, label) edge appears once
+        in the result; use merge(other, dedupe=False) to keep them.
         :param other: SGraph
         :return: SGraph
         """
+        return self.merge(other)
+
+    def merge(self, other, dedupe: bool = True):
+        """
+        The Merge function (||) of the HR algebra, see __add__.
+        The nodes of other are renamed and written straight into a copy of self in a single pass.
+        :param other: SGraph
+        :param dedupe: bool: if True, the result keeps only one copy of each edge
+                             (same origin, target and label).
+        :return: SGraph
+        """
         assert isinstance(other, type(self))
-        # copy both graphs so we don't mess with the originals
-        new_self = deepcopy(self)
-        new_other = deepcopy(other)
-
-        # rename all nodes in other
-        new_node = max(self.nodes.union(other.nodes)) + 1  # avoid all possible conflicts of node names
-        for node in other.nodes:
-            new_other.replace_node(node, new_node)
-            new_node += 1
-        # if self and other share any sources, make them the same in other as they are in self.
-        for source in self.sources:
-            if source in other.sources:
-                new_other.replace_node(new_other.sources[source], self.sources[source])
+        # copy self so we don't mess with the original
+        new_self = self._shallow_clone()
+        nodes, edges, node_labels = new_self.nodes, new_self.edges, new_self.node_labels
+        sources = new_self.sources
+
+        # rename all nodes in other in a single pass over each of its structures.
+        # if self and other share any sources, their nodes in other get the names they have in self,
+        # and the rest get fresh names that avoid all possible conflicts of node names
+        shared = {other.sources[source]: node for source, node in self.sources.items() if source in other.sources}
+        fresh = itertools.count(max(max(self.nodes, default=-1), max(other.nodes, default=-1)) + 1)
+        remap = {node: shared[node] if node in shared else next(fresh) for node in other.nodes}
 
         # update copy of self to include everything in other
-        new_self.nodes = self.nodes.union(new_other.nodes)
-        for origin in new_other.edges:
-            if origin in new_self.edges:
-                new_self.edges[origin] += new_other.edges[origin]
-            else:
-                new_self.edges[origin] = new_other.edges[origin]
-        # new_self.edges.update(new_other.edges)
-        new_self.sources.update(new_other.sources)
-        new_self.node_labels.update(new_other.node_labels)
+        nodes.update(remap.values())
+        # two nodes of other may become one, and nodes of other may be nodes of self,
+        # so merge rather than overwrite their edges
+        for origin, other_edges in other.edges.items():
+            edges.setdefault(remap[origin], []).extend(
+                (remap[target], _intern(label)) for target, label in other_edges)
+        if dedupe:
+            # merging shared sources can make parallel copies of the same edge; keep the first one
+            for origin in edges:
+                unique = list(dict.fromkeys(edges[origin]))
+                if len(unique) < len(edges[origin]):
+                    edges[origin] = unique
+        for source, n in other.sources.items():
+            sources[_intern(source)] = remap[n]
+        for n, label in other.node_labels.items():
+            node_labels[remap[n]] = _intern(label)
+        if other.sentence_ids is not None:
+            if new_self.sentence_ids is None:
+                new_self.sentence_ids = {}
+            for n, ids in other.sentence_ids.items():
+                new_self.sentence_ids.setdefault(remap[n], set()).update(ids)
         return new_self
 
     def forget(self, source: str):
@@ -224,8 +398,8 @@ class SGraph:
         if new_source in self.sources:
             raise GraphError(f"Can't rename {old_source} to {new_source}: {new_source} already exists")
         if old_source in self.sources:
-            node = self.sources.pop(old_source)
-            self.sources[new_source] = node
+            new_source = _intern(new_source)
+            self.sources[new_source] = self.sources.pop(old_source)
 
     def add_source(self, node, source):
         """
@@ -233,23 +407,25 @@ class SGraph:
         @param source: str: the source to assign to the node.
         @param node: the node to be given the source.
         """
-        if source in self.sources:
-            if self.sources[source] == node:
-                logger.warning(f"{node} already has source {source}")
-            else:
-                raise GraphError(f"{source} is already present in the graph")
-        self.sources[source] = node
+        source = _intern(source)
+        existing = self.sources.get(source, _SENTINEL)
+        if existing is _SENTINEL:
+            self.sources[source] = node
+        elif existing == node:  # not `is`: equal ints needn't be the same object
+            logger.warning(f"{node} already has source {source}")
+        else:
+            raise GraphError(f"{source} is already present in the graph")
 
     def print_parameters(self):
         """
         Print the graph in such a way that it's easy to build an SGraph by and using copy-paste.
         Returns: str
         """
-        ret = f"nodes={self.nodes}, "
-        ret += f"edges={self.edges}, "
-        ret += f"node_labels={self.node_labels}, "
-        ret += f"sources={self.sources}, "
-        ret += f"root={self.root}"
+        ret = ", ".join([f"nodes={self.nodes}",
+                         f"edges={self.edges}",
+                         f"node_labels={self.node_labels}",
+                         f"sources={self.sources}",
+                         f"root={self.root}"])
         print(ret)
         return ret
 
@@ -258,52 +434,90 @@ class SGraph:
         Make a graphviz (dot) representation of the graph.
         :return: str
         """
-        ret = "digraph g {\n"
+        parts = ["digraph g {\n"]
+        sources_by_node = self._sources_by_node()
         for node in self.nodes:
-            ret += f"{node}"
+            parts.append(f"{node}")
             label = self.get_node_label(node)
-            sources = self.get_sources_for_node(node)
+            sources = sources_by_node.get(node)
             if label or sources or self.is_root(node):
 
-                ret += " ["
+                parts.append(" [")
                 if self.is_root(node):
-                    ret += "style=bold, "
+                    parts.append("style=bold, ")
                 if label or sources:
-                    ret += "label=\""
+                    parts.append("label=\"")
                     if label:
-                        ret += f"{label}"
+                        parts.append(f"{label}")
                     if sources:
-                        ret += f"<{','.join(sources)}>"
-                ret += "\"]"
-            ret += ";\n"
-
-        for node in self.edges:
-            for target, label in self.edges[node]:
-                ret += f"{node}->{target} [label={label}];\n"
-        ret += "}"
-        return ret
+                        parts.append(f"<{','.join(sources)}>")
+                parts.append("\"]")
+            parts.append(";\n")
+
+        parts.extend(f"{node}->{target} [label={label}];\n"
+                     for node, edges in self.edges.items() for target, label in edges)
+        parts.append("}")
+        return "".join(parts)
+
+    def to_csr(self):
+        """
+        Export the edges in compressed sparse row (CSR) form for bulk traversal:
+        the edges of the i-th node are at positions row_ptr[i]:row_ptr[i+1] of
+        col_idx (the index of the target node) and label_ids (the index of the label).
+        This is an export-only helper for code that processes many graphs as arrays;
+        the methods of SGraph don't use it. It needs numpy.
+        Edge endpoints missing from self.nodes are indexed after the nodes, as in _get_triples.
+        Returns: (nodes, row_ptr, col_idx, label_ids, label_vocab), where
+            nodes is the list of nodes indexed by the arrays, sorted except for missing endpoints,
+            the next three are numpy int32 arrays,
+            and label_vocab is the list of edge labels indexed by label_ids.
+        """
+        import numpy as np
+        nodes = sorted(self.nodes)
+        node2index = {node: i for i, node in enumerate(nodes)}
+        # edges may point from or to nodes missing from self.nodes
+        for origin, edges in self.edges.items():
+            for node in itertools.chain((origin,), (target for target, _ in edges)):
+                if node not in node2index:
+                    node2index[node] = len(nodes)
+                    nodes.append(node)
+        label2index = {}
+        row_ptr, col_idx, label_ids = [0], [], []
+        for node in nodes:
+            for target, label in self.edges.get(node, []):
+                col_idx.append(node2index[target])
+                label_ids.append(label2index.setdefault(label, len(label2index)))
+            row_ptr.append(len(col_idx))
+        return (nodes,
+                np.array(row_ptr, dtype=np.int32),
+                np.array(col_idx, dtype=np.int32),
+                np.array(label_ids, dtype=np.int32),
+                list(label2index))
 
     def to_penman(self):
         """
         Export to penman.Graph
         Returns: penman.Graph
         """
-        triples = []
-        nodes_to_add = copy.copy(self.node_labels)
-
-        for source, node in self.sources.items():
-            label = f"<{source}>"
-            if node in nodes_to_add:
-                label = f"{nodes_to_add[node]}{label}"
-                nodes_to_add[node] = label
-            else:
+        if not self.sources:
+            # no sources to add to the node labels
+            triples = [(str(node), ":instance", label) for node, label in self.node_labels.items()]
+        else:
+            triples = []
+            nodes_to_add = dict(self.node_labels)
+
+            for source, node in self.sources.items():
+                label = f"<{source}>"
+                if node in nodes_to_add:
+                    label = f"{nodes_to_add[node]}{label}"
+                    nodes_to_add[node] = label
+                else:
+                    triples.append((str(node), ":instance", label))
+            for node, label in nodes_to_add.items():
                 triples.append((str(node), ":instance", label))
-        for node, label in nodes_to_add.items():
-            triples.append((str(node), ":instance", label))
 
-        for source, edges in self.edges.items():
-            for target, label in edges:
-                triples.append((str(source), label, str(target)))
+        triples.extend((str(source), label, str(target))
+                       for source, edges in self.edges.items() for target, label in edges)
 
         g = penman.graph.Graph(triples, top=str(self.root))
         return g
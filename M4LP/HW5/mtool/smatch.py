@@ -104,7 +104,8 @@ def build_arg_parser2():
 
 def get_best_match(instance1, attribute1, relation1,
                    instance2, attribute2, relation2,
-                   prefix1, prefix2, doinstance=True, doattribute=True, dorelation=True):
+                   prefix1, prefix2, doinstance=True, doattribute=True, dorelation=True,
+                   candidate_filter=None):
     """
     Get the highest triple match number between two sets of triples via hill-climbing.
     Arguments:
@@ -116,6 +117,8 @@ def get_best_match(instance1, attribute1, relation1,
         relation2: relation triples of AMR 2 (relation name, node 1 name, node 2 name)
         prefix1: prefix label for AMR 1
         prefix2: prefix label for AMR 2
+        candidate_filter: optional function from a pair of node indices (in AMR 1, in AMR 2) to bool;
+                          if given, only the pairs it accepts are considered for the mapping
     Returns:
         best_match: the node mapping that results in the highest triple matching number
         best_match_num: the highest triple matching number
@@ -128,6 +131,12 @@ def get_best_match(instance1, attribute1, relation1,
                                                      instance2, attribute2, relation2,
                                                      prefix1, prefix2, doinstance=doinstance, doattribute=doattribute,
                                                      dorelation=dorelation)
+    if candidate_filter is not None:
+        # prune the candidate pool, and the weights of the pruned node pairs
+        candidate_mappings = [set(j for j in candidates if candidate_filter(i, j))
+                              for i, candidates in enumerate(candidate_mappings)]
+        weight_dict = {pair: {p: w for p, w in weights.items() if p == -1 or candidate_filter(*p)}
+                       for pair, weights in weight_dict.items() if candidate_filter(*pair)}
     if veryVerbose:
         print("Candidate mappings:", file=DEBUG_LOG)
         print(candidate_mappings, file=DEBUG_LOG)
@@ -721,7 +730,8 @@ def generate_amr_lines(f1, f2):
 def get_amr_match(cur_amr1, cur_amr2, sent_num=1, justinstance=False, justattribute=False, justrelation=False,
                   limit = None,
                   instance1 = None, attributes1 = None, relation1 = None, prefix1 = None,
-                  instance2 = None, attributes2 = None, relation2 = None, prefix2 = None):
+                  instance2 = None, attributes2 = None, relation2 = None, prefix2 = None,
+                  candidate_filter = None):
     global iteration_num
     if limit is not None: iteration_num = limit
     if cur_amr1 and cur_amr2:
@@ -770,7 +780,8 @@ def get_amr_match(cur_amr1, cur_amr2, sent_num=1, justinstance=False, justattrib
     (best_mapping, best_match_num) = get_best_match(instance1, attributes1, relation1,
                                                     instance2, attributes2, relation2,
                                                     prefix1, prefix2, doinstance=doinstance,
-                                                    doattribute=doattribute, dorelation=dorelation)
+                                                    doattribute=doattribute, dorelation=dorelation,
+                                                    candidate_filter=candidate_filter)
     if verbose:
         print("best match number", best_match_num, file=DEBUG_LOG)
         print("best node mapping", best_mapping, file=DEBUG_LOG)